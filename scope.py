@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-from contextlib import contextmanager
+from contextlib import contextmanager, redirect_stdout
 import datetime
 from deepdiff import DeepDiff
 import fire
@@ -1880,6 +1880,8 @@ class Scope:
 
         :return:
         """
+        import io
+        import tempfile
         import uuid
         from tools import (
             generate_features,
@@ -1950,6 +1952,93 @@ class Scope:
                 save=False,
             )
 
+        with status("Test conversion of missing crossmatch values for streaming"):
+            print()
+            # Int64 and str columns are NaN for sources without a crossmatch
+            first_response = [
+                {'_id': 1, 'Gaia_EDR3___id': 5, 'AllWISE__ph_qual': 'AAA'}
+            ]
+            later_response = [
+                {'_id': 2, 'Gaia_EDR3___id': np.nan, 'AllWISE__ph_qual': np.nan},
+                {'_id': 3, 'Gaia_EDR3___id': 7.0, 'AllWISE__ph_qual': 'ABC'},
+            ]
+            schema = get_features._arrow_schema({}, get_features.dtype_dict)
+            first_table = get_features._response_table(first_response, schema)
+            later_table = get_features._response_table(later_response, schema)
+            assert later_table.schema.equals(first_table.schema)
+            assert later_table.column('Gaia_EDR3___id').to_pylist() == [None, 7]
+            assert later_table.column('AllWISE__ph_qual').to_pylist() == [None, 'ABC']
+
+        with status("Test streaming empty responses and missing columns"):
+            print()
+
+            class CannedKowalski:
+                def __init__(self, responses):
+                    self.responses = responses
+
+                def query(self, queries, **kwargs):
+                    return {'gloria': [self.responses.pop(0) for _ in queries]}
+
+            def success(data):
+                return {'status': 'success', 'data': data}
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                canned_path = os.path.join(tmpdir, 'canned.parquet')
+                # Empty first and later responses; Gaia_EDR3___id missing from the first data
+                canned = CannedKowalski(
+                    [
+                        success([]),
+                        success([{'_id': 2, 'ra': 1.0}]),
+                        success([]),
+                        success([{'_id': 4, 'ra': 2.0, 'Gaia_EDR3___id': 7}]),
+                    ]
+                )
+                get_features.get_features(
+                    source_ids=[1, 2, 3, 4],
+                    limit_per_query=1,
+                    Ncore=4,
+                    kowalski_instances=canned,
+                    parquet_path=canned_path,
+                )
+                canned_ftrs = read_parquet(canned_path)
+                assert canned_ftrs['_id'].tolist() == [2, 4]
+                assert canned_ftrs['Gaia_EDR3___id'].isna().tolist() == [True, False]
+                assert canned_ftrs['Gaia_EDR3___id'].iloc[1] == 7
+
+                # No file is written if no response has data
+                empty_path = os.path.join(tmpdir, 'empty.parquet')
+                get_features.get_features(
+                    source_ids=[1, 2],
+                    limit_per_query=1,
+                    Ncore=2,
+                    kowalski_instances=CannedKowalski([success([]), success([])]),
+                    parquet_path=empty_path,
+                )
+                assert not os.path.exists(empty_path)
+                assert os.listdir(tmpdir) == ['canned.parquet']
+
+                # A failed query raises and leaves no file behind
+                failed_path = os.path.join(tmpdir, 'failed.parquet')
+                failing = CannedKowalski(
+                    [
+                        success([{'_id': 1, 'ra': 1.0}]),
+                        {'status': 'error', 'message': 'timed out'},
+                    ]
+                )
+                try:
+                    get_features.get_features(
+                        source_ids=[1, 2],
+                        limit_per_query=1,
+                        Ncore=2,
+                        kowalski_instances=failing,
+                        parquet_path=failed_path,
+                    )
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError('failed query did not raise')
+                assert os.listdir(tmpdir) == ['canned.parquet']
+
         with status("Test get_features_loop and get_features"):
             print()
             test_ftrs, outfile = get_features.get_features_loop(
@@ -1971,6 +2060,52 @@ class Scope:
                 testpath_features.mkdir(parents=True, exist_ok=True)
             write_parquet(test_ftrs, str(testpath_features / 'field_0_iter_0.parquet'))
 
+        with status("Test streaming get_features_loop to parquet"):
+            print()
+            _, stream_outfile = get_features.get_features_loop(
+                get_features.get_features,
+                source_ids=lst[0],
+                features_catalog=self.config['kowalski']['collections']['features'],
+                field=0,
+                limit_per_query=5,
+                max_sources=len(lst[0]),
+                suffix='stream_test',
+                save=True,
+            )
+
+            stream_path = pathlib.Path(f'{stream_outfile}_iter_0.parquet')
+            backup_path = pathlib.Path(f'{stream_outfile}_iter_0_backup.parquet')
+            next_path = pathlib.Path(f'{stream_outfile}_iter_1.parquet')
+            try:
+                streamed_ftrs = read_parquet(str(stream_path))
+                assert set(streamed_ftrs['_id']) == set(test_ftrs['_id'])
+                assert 'features_ztf_dataRelease' in streamed_ftrs.attrs
+
+                # Resuming skips saved ids; a stray backup file must not break the parse
+                shutil.copy(stream_path, backup_path)
+                resume_output = io.StringIO()
+                with redirect_stdout(resume_output):
+                    resumed = get_features.get_features_loop(
+                        get_features.get_features,
+                        source_ids=lst[0],
+                        features_catalog=self.config['kowalski']['collections'][
+                            'features'
+                        ],
+                        field=0,
+                        limit_per_query=5,
+                        max_sources=len(lst[0]),
+                        restart=False,
+                        suffix='stream_test',
+                        save=True,
+                    )
+                assert resumed is None
+                assert 'Dataset is already complete.' in resume_output.getvalue()
+                assert not next_path.exists()
+            finally:
+                for path in (stream_path, backup_path, next_path):
+                    if path.exists():
+                        path.unlink()
+
         # create a mock dataset and check that the training pipeline works
         dataset_orig = f"{uuid.uuid4().hex}_orig.csv"
         dataset = f"{uuid.uuid4().hex}.csv"
@@ -12,6 +12,7 @@ __all__ = [
     "write_hdf",
     "read_parquet",
     "write_parquet",
+    "parquet_writer",
     "impute_features",
     "removeHighCadence",
     "TychoBVfromGaia",
@@ -40,6 +41,11 @@ import json as JSON
 from sklearn.impute import KNNImputer
 import seaborn as sns
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 BASE_DIR = pathlib.Path(__file__).parent.parent.absolute()
 
 
@@ -48,7 +54,7 @@ def load_config(config_path: Union[str, pathlib.Path]):
     Load config and secrets
     """
     with open(config_path) as config_yaml:
-        config = yaml.load(config_yaml, Loader=yaml.FullLoader)
+        config = yaml.load(config_yaml, Loader=SafeLoader)
 
     return config
 
@@ -154,6 +160,29 @@ def write_parquet(dataframe: pd.DataFrame, filepath: str, meta_key: str = 'scope
     pq.write_table(table, filepath)
 
 
+def parquet_writer(
+    schema: pa.Schema, filepath: str, metadata: dict, meta_key: str = 'scope'
+):
+    """
+    Open Apache Parquet writer for streaming tables, attaching Metadata to the schema
+
+    :param schema: pyarrow.Schema of the tables to be written
+    :param filepath: file path to save parquet file (str)
+    :param metadata: metadata to save (dict)
+    :param meta_key: key associated with metadata to save (str)
+
+    :return: pyarrow.parquet.ParquetWriter
+    """
+    existing_meta = schema.metadata if schema.metadata is not None else {}
+    combined_meta = {
+        meta_key.encode(): JSON.dumps(metadata).encode(),
+        **existing_meta,
+    }
+    schema = schema.with_metadata(combined_meta)
+
+    return pq.ParquetWriter(filepath, schema)
+
+
 def read_parquet(filepath: str, meta_key: str = 'scope'):
     """
     Read Apache Parquet file and metadata (if available)
@@ -512,8 +541,13 @@ def impute_features(
     features_df: pd.DataFrame,
     n_neighbors: int = 5,
     self_impute: bool = False,
+    fill_values: Optional[dict] = None,
     **kwargs,
 ):
+    # If fill_values dict is provided, median/mean fill values are read from it when present
+    # and added to it otherwise (allows reuse across batches imputed from the training set;
+    # not meant for self_impute=True, where the fill values depend on the batch)
+
     # Load config file
     config = load_config(BASE_DIR / "config.yaml")
 
@@ -583,7 +617,13 @@ def impute_features(
     print('Imputing median for the following features: ', feature_list_impute_median)
     print()
     for feat in feature_list_impute_median:
-        features_df[feat] = features_df[feat].fillna(np.nanmedian(referenceSet[feat]))
+        if (fill_values is not None) and (feat in fill_values):
+            fill_value = fill_values[feat]
+        else:
+            fill_value = np.nanmedian(referenceSet[feat])
+            if fill_values is not None:
+                fill_values[feat] = fill_value
+        features_df[feat] = features_df[feat].fillna(fill_value)
 
     # Impute mean from reference set where specified
     feature_list_impute_mean = [
@@ -604,7 +644,13 @@ def impute_features(
     print('Imputing mean for the following features: ', feature_list_impute_mean)
     print()
     for feat in feature_list_impute_mean:
-        features_df[feat] = features_df[feat].fillna(np.nanmean(referenceSet[feat]))
+        if (fill_values is not None) and (feat in fill_values):
+            fill_value = fill_values[feat]
+        else:
+            fill_value = np.nanmean(referenceSet[feat])
+            if fill_values is not None:
+                fill_values[feat] = fill_value
+        features_df[feat] = features_df[feat].fillna(fill_value)
 
     # Impute via regression where specified
     feature_list_regression = [
@@ -1,54 +1,52 @@
 #!/usr/bin/env python
 import fire
+import functools
+import multiprocessing
 import numpy as np
 import pandas as pd
+from pandas.api.types import pandas_dtype
 import pathlib
+import re
 from penquins import Kowalski
-from typing import List
-import yaml
+from typing import List, Union
 import os
 import time
 import h5py
-from scope.utils import write_parquet, impute_features
+from scope.utils import load_config, write_parquet, parquet_writer, impute_features
 from datetime import datetime
+import pyarrow as pa
 import pyarrow.dataset as ds
 
 BASE_DIR = os.path.dirname(__file__)
+FEATURES_DIR = pathlib.Path(__file__).resolve().parent.parent / "features"
 JUST = 50
 
 
 config_path = pathlib.Path(__file__).parent.parent.absolute() / "config.yaml"
-with open(config_path) as config_yaml:
-    config = yaml.load(config_yaml, Loader=yaml.FullLoader)
+config = load_config(config_path)
 
 # Access datatypes in config file
 all_feature_names_config = config["features"]["ontological"]
+period_suffix = config['features']['info']['period_suffix']
+
+
+def _rename(name: str) -> str:
+    '''
+    Rename periodic feature columns if suffix provided in config (features: info: period_suffix:)
+    '''
+    if (period_suffix is None) | (period_suffix == 'None'):
+        return name
+    if all_feature_names_config[name]['periodic']:
+        return f'{name}_{period_suffix}'
+    return name
+
+
 dtype_dict = {
-    key: all_feature_names_config[key]['dtype'] for key in all_feature_names_config
+    _rename(key): value['dtype'] for key, value in all_feature_names_config.items()
 }
 
 # Only features listed in config (regardless of include:) will be downloaded
-projection_dict = {key: 1 for key in all_feature_names_config}
-
-period_suffix = config['features']['info']['period_suffix']
-# Rename periodic feature columns if suffix provided in config (features: info: period_suffix:)
-if not ((period_suffix is None) | (period_suffix == 'None')):
-    all_feature_names = [x for x in all_feature_names_config.keys()]
-    periodic_bool = [all_feature_names_config[x]['periodic'] for x in all_feature_names]
-    for j, name in enumerate(all_feature_names):
-        if periodic_bool[j]:
-            all_feature_names[j] = f'{name}_{period_suffix}'
-
-    dtype_values = [x for x in dtype_dict.values()]
-    projection_values = [x for x in projection_dict.values()]
-
-    dtype_dict = {
-        all_feature_names[i]: dtype_values[i] for i in range(len(dtype_values))
-    }
-    projection_dict = {
-        all_feature_names[i]: projection_values[i]
-        for i in range(len(projection_values))
-    }
+projection_dict = {_rename(key): 1 for key in all_feature_names_config}
 
 # use tokens specified as env vars (if exist)
 kowalski_token_env = os.environ.get("KOWALSKI_INSTANCE_TOKEN")
@@ -80,12 +78,105 @@ instances = {
     for host in hosts
 }
 
-kowalski_instances = Kowalski(timeout=timeout, instances=instances)
+
+@functools.lru_cache(maxsize=None)
+def _kowalski_instances() -> Kowalski:
+    '''
+    Connect to Kowalski instances once per process.
+    '''
+    return Kowalski(timeout=timeout, instances=instances)
+
+
+@functools.lru_cache(maxsize=None)
+def _resolved_dtypes(columns: tuple) -> dict:
+    '''
+    Map returned columns to their dtypes in dtype_dict (cached per column set).
+    '''
+    return {col: pandas_dtype(dtype_dict[col]) for col in columns if col in dtype_dict}
+
+
+def _cast_dtypes(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    '''
+    Cast returned columns to their configured dtypes, skipping those that already match.
+    '''
+    if dtypes is dtype_dict:
+        resolved_dtypes = _resolved_dtypes(tuple(df.columns))
+    else:
+        resolved_dtypes = {
+            col: pandas_dtype(dtypes[col]) for col in df.columns if col in dtypes
+        }
+    # Only cast columns whose returned dtype differs from the config
+    needs_cast = {
+        col: dtype for col, dtype in resolved_dtypes.items() if df[col].dtype != dtype
+    }
+    if len(needs_cast) > 0:
+        df = df.astype(dtype=needs_cast, copy=False)
+    return df
+
+
+# Arrow types of configured columns that pandas cannot infer from an empty column
+ARROW_TYPES = {
+    'str': pa.string(),
+    'dmdt': pa.list_(pa.list_(pa.float64())),
+    'coordinates': pa.struct(
+        [
+            (
+                'radec_geojson',
+                pa.struct(
+                    [('type', pa.string()), ('coordinates', pa.list_(pa.float64()))]
+                ),
+            )
+        ]
+    ),
+}
+
+
+def _arrow_schema(projection: dict, dtypes: dict) -> Union[pa.Schema, None]:
+    '''
+    Build the Arrow schema of streamed features from the configured dtypes.
+    Columns are those in projection (or all of dtypes if projection is empty), plus _id.
+    Returns None if any column has no known dtype, in which case features cannot be streamed.
+    '''
+    columns = list(projection) if projection != {} else list(dtypes)
+    if '_id' not in columns:
+        columns = ['_id'] + columns
+    if any(col not in dtypes for col in columns):
+        return None
+
+    # pandas metadata is kept so that e.g. Int64 columns are restored on read
+    empty_df = pd.DataFrame(
+        {col: pd.Series(dtype=pandas_dtype(dtypes[col])) for col in columns}
+    )
+    schema = pa.Schema.from_pandas(empty_df, preserve_index=False)
+    for i, col in enumerate(columns):
+        if pa.types.is_null(schema.field(col).type):
+            arrow_type = ARROW_TYPES.get(col, ARROW_TYPES.get(dtypes[col]))
+            if arrow_type is None:
+                return None
+            schema = schema.set(i, pa.field(col, arrow_type))
+    return schema
+
+
+def _response_table(source_data: list, schema: pa.Schema) -> pa.Table:
+    '''
+    Convert one Kowalski response directly to an Arrow table with the given schema.
+    NaN (e.g. in Int64/str columns of sources without a crossmatch) and missing keys
+    become null; keys not in the schema are ignored.
+    '''
+    arrays = [
+        pa.array(
+            [doc.get(field.name) for doc in source_data],
+            type=field.type,
+            from_pandas=True,
+        )
+        for field in schema
+    ]
+    return pa.Table.from_arrays(arrays, schema=schema)
 
 
 def get_features_loop(
     func,
-    source_ids: List[int],
+    source_ids: Union[List[int], np.ndarray],
     features_catalog: str = "ZTF_source_features_DR5",
     verbose: bool = False,
     whole_field: bool = True,
@@ -101,63 +192,82 @@ def get_features_loop(
     projection: dict = {},
     suffix: str = None,
     save: bool = True,
+    Ncore: int = 8,
+    kowalski_instances: Kowalski = None,
 ):
     '''
     Loop over get_features.py to save at specified checkpoints.
     '''
 
+    field_dir = FEATURES_DIR / f'field_{field}'
     if not whole_field:
-        outfile = (
-            os.path.dirname(__file__)
-            + "/../features/field_"
-            + str(field)
-            + "/ccd_"
-            + str(ccd).zfill(2)
-            + "_quad_"
-            + str(quad)
-        )
-
+        outfile = field_dir / f'ccd_{str(ccd).zfill(2)}_quad_{quad}'
     else:
-        outfile = (
-            os.path.dirname(__file__)
-            + "/../features/field_"
-            + str(field)
-            + "/"
-            + "field_"
-            + str(field)
-        )
+        outfile = field_dir / f'field_{field}'
 
     if suffix is not None:
-        outfile += f'_{suffix}'
-    os.makedirs(os.path.dirname(outfile), exist_ok=True)
-
-    DS = ds.dataset(os.path.dirname(outfile), format='parquet')
-    indiv_files = DS.files
+        outfile = outfile.with_name(f'{outfile.name}_{suffix}')
+    field_dir.mkdir(parents=True, exist_ok=True)
+
+    # Only consider this output's own files: with n_processes > 1, other workers
+    # stream into the same field directory concurrently
+    iter_pattern = re.compile(rf'^{re.escape(outfile.name)}_iter_(\d+)\.parquet$')
+    iter_matches = [iter_pattern.match(f.name) for f in field_dir.iterdir()]
+    iter_matches = [m for m in iter_matches if m is not None]
+    indiv_files = [str(field_dir / m.group(0)) for m in iter_matches]
     files_exist = len(indiv_files) > 0
-    existing_ids = []
+    start_iteration = 0
+
+    # Keep ids as an int64 array; slices are views until the $in filter is built
+    source_ids = np.asarray(source_ids, dtype=np.int64)
 
     # Set source_ids
     if (not restart) & (files_exist):
-        generator = DS.to_batches(columns=['_id'])
-        for batch in generator:
-            existing_ids += batch['_id'].to_pylist()
-        # Remove existing source_ids from list
-        todo_source_ids = list(set(source_ids) - set(existing_ids))
+        # Push the id filter down to the dataset scan to only read requested ids
+        DS = ds.dataset(indiv_files, format='parquet')
+        existing_ids = (
+            DS.to_table(
+                columns=['_id'],
+                filter=ds.field('_id').isin(pa.array(source_ids)),
+            )
+            .column('_id')
+            .combine_chunks()
+            .to_numpy(zero_copy_only=False)
+        )
+        # Remove existing source_ids from list (keeping the original order)
+        todo_source_ids = source_ids[~np.isin(source_ids, existing_ids)]
         if len(todo_source_ids) == 0:
             print('Dataset is already complete.')
             return
+        source_ids = todo_source_ids
+
+        # Number new files after existing iterations to avoid overwriting them
+        start_iteration = max(int(m.group(1)) for m in iter_matches) + 1
 
     n_sources = len(source_ids)
     if n_sources % max_sources != 0:
         n_iterations = n_sources // max_sources + 1
     else:
         n_iterations = n_sources // max_sources
-    start_iteration = len(existing_ids) // max_sources
 
-    for i in range(start_iteration, n_iterations):
-        print(f"Iteration {i+1} of {n_iterations}...")
+    # Stream Kowalski responses straight to parquet unless the full dataframe is needed
+    # (or the dtypes of some projected columns are not configured)
+    stream = (
+        save
+        & (not impute_missing_features)
+        & (not write_csv)
+        & (_arrow_schema(projection, dtype_dict) is not None)
+    )
+
+    # Median/mean imputation values from the training set are computed once and reused
+    # for every iteration; self-imputed values depend on each iteration's own sources
+    fill_values = {} if not self_impute else None
+
+    for j in range(n_iterations):
+        print(f"Iteration {j+1} of {n_iterations}...")
+        i = start_iteration + j
         select_source_ids = source_ids[
-            i * max_sources : min(n_sources, (i + 1) * max_sources)
+            j * max_sources : min(n_sources, (j + 1) * max_sources)
         ]
 
         df, _ = func(
@@ -168,19 +278,24 @@ def get_features_loop(
             impute_missing_features=impute_missing_features,
             self_impute=self_impute,
             projection=projection,
+            Ncore=Ncore,
+            kowalski_instances=kowalski_instances,
+            parquet_path=f'{outfile}_iter_{i}.parquet' if stream else None,
+            fill_values=fill_values,
         )
 
         if save:
-            write_parquet(df, f'{outfile}_iter_{i}.parquet')
+            if not stream:
+                write_parquet(df, f'{outfile}_iter_{i}.parquet')
             files_exist = True
             if write_csv:
                 df.to_csv(f'{outfile}_iter_{i}.csv', index=False)
 
-    return df, outfile
+    return df, str(outfile)
 
 
 def get_features(
-    source_ids: List[int],
+    source_ids: Union[List[int], np.ndarray],
     features_catalog: str = "ZTF_source_features_DR5",
     verbose: bool = False,
     limit_per_query: int = 1000,
@@ -188,86 +303,255 @@ def get_features(
     self_impute: bool = True,
     dtypes: dict = dtype_dict,
     projection: dict = projection_dict,
+    Ncore: int = 8,
+    kowalski_instances: Kowalski = None,
+    parquet_path: str = None,
+    fill_values: dict = None,
 ):
     '''
     Get features of all ids present in the field in one file.
+    Queries of limit_per_query ids are submitted Ncore at a time as a batch query.
+    If kowalski_instances is not provided, a connection cached per process is used.
+    If parquet_path is set, each response is written directly to that file instead
+    of being collected in memory (returns None, None); only columns with configured
+    dtypes are written.
+    If fill_values is provided, median/mean imputation values are cached in it for reuse.
     '''
+    if kowalski_instances is None:
+        kowalski_instances = _kowalski_instances()
+
+    # Metadata
+    utcnow = datetime.utcnow()
+    start_dt = utcnow.strftime("%Y-%m-%d %H:%M:%S")
+    features_ztf_dr = features_catalog.split('_')[-1]
+    metadata = {
+        'features_download_dateTime_utc': start_dt,
+        'features_ztf_dataRelease': features_ztf_dr,
+        'features_imputed': impute_missing_features,
+    }
+
+    if (parquet_path is not None) & impute_missing_features:
+        raise ValueError('Cannot stream features to parquet when imputing.')
+    writer = None
+    if parquet_path is not None:
+        schema = _arrow_schema(projection, dtypes)
+        if schema is None:
+            raise ValueError(
+                'Cannot stream features to parquet: some columns have no configured dtype.'
+            )
+        # Hidden name: skipped by pyarrow dataset discovery until complete
+        tmp_parquet_path = os.path.join(
+            os.path.dirname(parquet_path), f'.{os.path.basename(parquet_path)}.tmp'
+        )
 
-    id = 0
     df_collection = []
-    dmdt_temp = []
-    dmdt_collection = []
-
-    while True:
-        query = {
-            "query_type": "find",
-            "query": {
-                "catalog": features_catalog,
-                "filter": {
-                    "_id": {
-                        "$in": source_ids[
-                            id * limit_per_query : (id + 1) * limit_per_query
-                        ]
-                    }
-                },
-                "projection": projection,
-            },
-        }
-        responses = kowalski_instances.query(query=query)
-
-        for name in responses.keys():
-            if len(responses[name]) > 0:
-                response = responses[name]
-                if response.get("status", "error") == "success":
-                    source_data = response.get("data")
-                    if source_data is None:
-                        print(response)
-                        raise ValueError(f"No data found for source ids {source_ids}")
-
-        df_temp = pd.DataFrame(source_data)
-        if (projection == {}) | ("dmdt" in projection):
-            df_temp = df_temp.astype(dtype=dtypes)
-        df_collection += [df_temp]
-        try:
-            dmdt_temp = np.expand_dims(
-                np.array([d for d in df_temp['dmdt'].values]), axis=-1
+
+    source_ids = np.asarray(source_ids, dtype=np.int64)
+    n_sources = len(source_ids)
+    # Only build dmdt if using the default projection or user requests the feature
+    want_dmdt = (projection == {}) | ("dmdt" in projection)
+    # dmdt buffer is allocated once (at most n_sources rows) on the first successful batch
+    dmdt = None
+    dmdt_offset = 0
+    n_queries = max(1, int(np.ceil(n_sources / limit_per_query)))
+
+    completed = False
+    try:
+        itr = 0
+        while itr < n_queries:
+            # Build queries for the next Ncore slices; ids are converted to list only here
+            batch_queries = [
+                {
+                    "query_type": "find",
+                    "query": {
+                        "catalog": features_catalog,
+                        "filter": {
+                            "_id": {
+                                "$in": source_ids[
+                                    i * limit_per_query : (i + 1) * limit_per_query
+                                ].tolist()
+                            }
+                        },
+                        "projection": projection,
+                    },
+                }
+                for i in range(itr, min(itr + Ncore, n_queries))
+            ]
+            responses = kowalski_instances.query(
+                queries=batch_queries, use_batch_query=True, max_n_threads=Ncore
             )
-        except Exception as e:
-            # Print dmdt error if using the default projection or user requests the feature
-            if (projection == {}) | ("dmdt" in projection):
-                print("Error", e)
-                print(df_temp)
-        dmdt_collection += [dmdt_temp]
-
-        if ((id + 1) * limit_per_query) >= len(source_ids):
-            print(f'{len(source_ids)} done')
-            break
-        id += 1
-        if (id * limit_per_query) % limit_per_query == 0:
-            print(id * limit_per_query, "done")
+
+            source_data_list = []
+            for name in responses.keys():
+                if len(responses[name]) > 0:
+                    response_list = responses[name]
+                    for response in response_list:
+                        # Fail rather than save a file with the queried ids missing
+                        if response.get("status", "error") != "success":
+                            print(response)
+                            raise ValueError(
+                                f"Query failed for source ids {source_ids}"
+                            )
+                        source_data = response.get("data")
+                        if source_data is None:
+                            print(response)
+                            raise ValueError(
+                                f"No data found for source ids {source_ids}"
+                            )
+                        source_data_list.append(source_data)
+
+            for source_data in source_data_list:
+                # Nothing to write (or stack) for queries without matching ids
+                if len(source_data) == 0:
+                    continue
+                if parquet_path is not None:
+                    if writer is None:
+                        writer = parquet_writer(schema, tmp_parquet_path, metadata)
+                    writer.write_table(_response_table(source_data, schema))
+                    continue
+
+                df_temp = pd.DataFrame(source_data)
+                if want_dmdt:
+                    df_temp = _cast_dtypes(df_temp, dtypes)
+
+                df_collection.append(df_temp)
+                if not want_dmdt:
+                    continue
+                try:
+                    dmdt_temp = np.stack(df_temp['dmdt'].values)[..., np.newaxis]
+                    n_rows = len(dmdt_temp)
+                    if dmdt is None:
+                        dmdt = np.empty(
+                            (max(n_sources, n_rows),) + dmdt_temp.shape[1:],
+                            dtype=dmdt_temp.dtype,
+                        )
+                    elif dmdt_offset + n_rows > len(dmdt):
+                        # More rows than requested ids (e.g. returned by several instances)
+                        dmdt = np.concatenate([dmdt, np.empty_like(dmdt_temp)])
+                    dmdt[dmdt_offset : dmdt_offset + n_rows] = dmdt_temp
+                    dmdt_offset += n_rows
+                except Exception as e:
+                    print("Error", e)
+                    print(df_temp)
+
+            itr += len(batch_queries)
+            if itr < n_queries:
+                print(itr * limit_per_query, "done")
+            else:
+                print(f'{n_sources} done')
+        completed = True
+    finally:
+        if writer is not None:
+            writer.close()
+            if not completed:
+                os.remove(tmp_parquet_path)
+
+    if parquet_path is not None:
+        if writer is not None:
+            # Move the file into place only once it is complete
+            os.replace(tmp_parquet_path, parquet_path)
+        return None, None
 
     df = pd.concat(df_collection, axis=0)
     df.reset_index(drop=True, inplace=True)
-    dmdt = np.vstack(dmdt_collection)
+    if dmdt is not None:
+        dmdt = dmdt[:dmdt_offset]
+    elif want_dmdt:
+        dmdt = np.array([])
 
     if impute_missing_features:
-        df = impute_features(df, self_impute=self_impute)
+        df = impute_features(df, self_impute=self_impute, fill_values=fill_values)
 
     # Add metadata
-    utcnow = datetime.utcnow()
-    start_dt = utcnow.strftime("%Y-%m-%d %H:%M:%S")
-    features_ztf_dr = features_catalog.split('_')[-1]
-    df.attrs['features_download_dateTime_utc'] = start_dt
-    df.attrs['features_ztf_dataRelease'] = features_ztf_dr
-    df.attrs['features_imputed'] = impute_missing_features
+    df.attrs.update(metadata)
 
     if verbose:
         print("Features dataframe: ", df)
-        print("dmdt shape: ", dmdt.shape)
+        if dmdt is not None:
+            print("dmdt shape: ", dmdt.shape)
 
     return df, dmdt
 
 
+def _init_worker():
+    '''
+    Make each worker process open its own Kowalski connection.
+    '''
+    _kowalski_instances.cache_clear()
+
+
+def _get_features_ccd_quad(key, default_file: str, options: dict):
+    '''
+    Get features for the ids of one ccd/quad (or whole field) file; see run for options.
+    '''
+    field = options['field']
+    start = options['start']
+    end = options['end']
+    if type(key) == tuple:
+        ccd_quad = key
+        print(f'Getting features for ccd {ccd_quad[0]} quad {ccd_quad[1]}...')
+    else:
+        ccd_quad = (0, 0)
+        print(f'Getting features for field {field}...')
+    source_ids_filename = options['source_ids_filename']
+    if source_ids_filename is None:
+        source_ids_filename = default_file
+
+    tm = options['time']
+    filename = os.path.join(BASE_DIR, source_ids_filename)
+
+    ts = time.time()
+    with h5py.File(filename, "r") as f:
+        source_ids = f[list(f.keys())[0]][()].astype(np.int64, copy=False)
+    te = time.time()
+    if tm:
+        print(
+            "read source_ids from .h5".ljust(JUST)
+            + "\t --> \t"
+            + str(round(te - ts, 4))
+            + " s"
+        )
+
+    verbose = options['verbose']
+    if verbose:
+        print(f"{len(source_ids)} total source ids")
+
+    if options['write_results']:
+        get_features_loop(
+            get_features,
+            source_ids=source_ids[start:end],
+            features_catalog=options['features_catalog'],
+            verbose=verbose,
+            whole_field=options['whole_field'],
+            field=field,
+            ccd=ccd_quad[0],
+            quad=ccd_quad[1],
+            limit_per_query=options['limit_per_query'],
+            max_sources=options['max_sources'],
+            impute_missing_features=options['impute_missing_features'],
+            self_impute=options['self_impute'],
+            restart=options['restart'],
+            write_csv=options['write_csv'],
+            projection=options['projection'],
+            suffix=options['suffix'],
+            save=True,
+            Ncore=options['Ncore'],
+        )
+
+    else:
+        # get raw features
+        get_features(
+            source_ids=source_ids[start:end],
+            features_catalog=options['features_catalog'],
+            verbose=verbose,
+            limit_per_query=options['limit_per_query'],
+            impute_missing_features=options['impute_missing_features'],
+            self_impute=options['self_impute'],
+            projection=options['projection'],
+            Ncore=options['Ncore'],
+        )
+
+
 def run(**kwargs):
     """
     Get the features of all sources in a field.
@@ -282,6 +566,10 @@ def run(**kwargs):
         Quadrant range; single int or list of two ints between 1 and 4 (default range is [1,4])
     limit_per_query: int
         Number of sources to query at a time.
+    Ncore: int
+        Number of queries (of limit_per_query sources each) to submit concurrently to Kowalski in one batch query.
+    n_processes: int
+        Number of ccd/quads to process in parallel (each process submits Ncore concurrent queries).
     max_sources: int
         Number of sources to save in single file.
     features_catalog: str
@@ -313,6 +601,8 @@ def run(**kwargs):
     DEFAULT_CCD_RANGE = [1, 16]
     DEFAULT_QUAD_RANGE = [1, 4]
     DEFAULT_LIMIT = 1000
+    DEFAULT_NCORE = 8
+    DEFAULT_NPROCESSES = 1
     DEFAULT_SAVE_BATCHSIZE = 100000
     features_catalog = config['kowalski']['collections']['features']
     DEFAULT_CATALOG = features_catalog
@@ -321,6 +611,8 @@ def run(**kwargs):
     ccd_range = kwargs.get("ccd_range", DEFAULT_CCD_RANGE)
     quad_range = kwargs.get("quad_range", DEFAULT_QUAD_RANGE)
     limit_per_query = kwargs.get("limit_per_query", DEFAULT_LIMIT)
+    Ncore = kwargs.get("Ncore", DEFAULT_NCORE)
+    n_processes = kwargs.get("n_processes", DEFAULT_NPROCESSES)
     max_sources = kwargs.get("max_sources", DEFAULT_SAVE_BATCHSIZE)
     features_catalog = kwargs.get("features_catalog", DEFAULT_CATALOG)
     whole_field = kwargs.get("whole_field", False)
@@ -350,82 +642,47 @@ def run(**kwargs):
         for ccd in range(ccd_range[0], ccd_range[1] + 1):
             for quad in range(quad_range[0], quad_range[1] + 1):
                 default_file = (
-                    "../ids/field_"
-                    + str(field)
-                    + "/data_ccd_"
-                    + str(ccd).zfill(2)
-                    + "_quad_"
-                    + str(quad)
-                    + ".h5"
+                    f"../ids/field_{field}/data_ccd_{str(ccd).zfill(2)}_quad_{quad}.h5"
                 )
                 iter_dct[(ccd, quad)] = default_file
     else:
-        default_file = "../ids/field_" + str(field) + "/field_" + str(field) + ".h5"
+        default_file = f"../ids/field_{field}/field_{field}.h5"
         iter_dct[field] = default_file
 
-    for k, v in iter_dct.items():
-        if type(k) == tuple:
-            ccd_quad = k
-            print(f'Getting features for ccd {ccd_quad[0]} quad {ccd_quad[1]}...')
-        else:
-            ccd_quad = (0, 0)
-            print(f'Getting features for field {field}...')
-        default_file = v
-        source_ids_filename = kwargs.get("source_ids_filename", default_file)
-
-        tm = kwargs.get("time", False)
-        filename = os.path.join(BASE_DIR, source_ids_filename)
-
-        ts = time.time()
-        source_ids = np.array([])
-        with h5py.File(filename, "r") as f:
-            ids = np.array(f[list(f.keys())[0]])
-            source_ids = list(map(int, np.concatenate((source_ids, ids), axis=0)))
-        te = time.time()
-        if tm:
-            print(
-                "read source_ids from .h5".ljust(JUST)
-                + "\t --> \t"
-                + str(round(te - ts, 4))
-                + " s"
-            )
-
-        verbose = kwargs.get("verbose", False)
-        if verbose:
-            print(f"{len(source_ids)} total source ids")
-
-        if write_results:
-            get_features_loop(
-                get_features,
-                source_ids=source_ids[start:end],
-                features_catalog=features_catalog,
-                verbose=verbose,
-                whole_field=whole_field,
-                field=field,
-                ccd=ccd_quad[0],
-                quad=ccd_quad[1],
-                limit_per_query=limit_per_query,
-                max_sources=max_sources,
-                impute_missing_features=impute_missing_features,
-                self_impute=self_impute,
-                restart=restart,
-                write_csv=write_csv,
-                projection=projection,
-                suffix=suffix,
-                save=True,
-            )
-
-        else:
-            # get raw features
-            get_features(
-                source_ids=source_ids[start:end],
-                features_catalog=features_catalog,
-                verbose=verbose,
-                limit_per_query=limit_per_query,
-                impute_missing_features=impute_missing_features,
-                self_impute=self_impute,
-                projection=projection,
+    options = dict(
+        field=field,
+        whole_field=whole_field,
+        start=start,
+        end=end,
+        source_ids_filename=kwargs.get("source_ids_filename", None),
+        time=kwargs.get("time", False),
+        verbose=kwargs.get("verbose", False),
+        write_results=write_results,
+        features_catalog=features_catalog,
+        limit_per_query=limit_per_query,
+        max_sources=max_sources,
+        impute_missing_features=impute_missing_features,
+        self_impute=self_impute,
+        restart=restart,
+        write_csv=write_csv,
+        projection=projection,
+        suffix=suffix,
+        Ncore=Ncore,
+    )
+
+    n_processes = min(n_processes, len(iter_dct))
+    if n_processes > 1:
+        # ccd/quads are independent: process them in parallel, one Kowalski connection per worker
+        with multiprocessing.Pool(
+            processes=n_processes, initializer=_init_worker
+        ) as pool:
+            pool.starmap(
+                _get_features_ccd_quad,
+                [(k, v, options) for k, v in iter_dct.items()],
             )
+    else:
+        for k, v in iter_dct.items():
+            _get_features_ccd_quad(k, v, options)
 
 
 if __name__ == "__main__":